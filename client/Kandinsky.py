@@ -40,6 +40,8 @@ class KandinskyWindow(gtk.Window):
       Ползунок с количеством генерируемых изображений
   server_host_entry : gtk.Entry
       Поле с хостом
+  draft_checkbutton : gtk.CheckButton
+      Флаг чернового прохода перед полным
 
   Методы
   ------
@@ -49,6 +51,8 @@ class KandinskyWindow(gtk.Window):
       Получает и возвращает путь к RC-файлу, в котром описана текущая тема редактора
   get_textview_value(widget)
       Возвращает значение виджета типа TextView (текстовое поле)
+  ask_refine()
+      Спрашивает пользователя, запускать ли полный проход для черновика
   on_click(widget)
       Обработчик события pressed кнопки ok, определенной в конструкторе класса
   """
@@ -141,6 +145,12 @@ class KandinskyWindow(gtk.Window):
     table1.attach(label5, 0, 2, 0, 1)
     table1.attach(self.server_host_entry, 2, 5, 0, 1)
 
+    self.draft_checkbutton = gtk.CheckButton('Draft preview before full-quality pass')
+    self.draft_checkbutton.set_can_focus(False)
+    self.draft_checkbutton.set_active(False)
+
+    table1.attach(self.draft_checkbutton, 0, 5, 1, 2)
+
     # Объединение всех вкладок в единый Notebook
 
     notebook = gtk.Notebook()
@@ -207,6 +217,16 @@ class KandinskyWindow(gtk.Window):
     text = buffer.get_text(startIter, endIter, False) 
     return text
 
+  def ask_refine(self):
+    """Спрашивает пользователя, запускать ли полный проход для показанного черновика
+    """
+    dialog = gtk.MessageDialog(
+      self, gtk.DIALOG_MODAL, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO,
+      'Run the full-quality pass for this draft?')
+    response = dialog.run()
+    dialog.destroy()
+    return response == gtk.RESPONSE_YES
+
   def on_click(self, widget):
     """Обработчик события pressed кнопки ok, определенной в конструкторе класса
     """
@@ -249,7 +269,10 @@ class KandinskyWindow(gtk.Window):
       'decoder_steps': int(decoder_steps),
       'prior_steps': int(prior_steps),
       'cgs_scale': int(cgs_scale),
-      'image_number': int(output_images)
+      'image_number': int(output_images),
+      'draft': self.draft_checkbutton.get_active(),
+      # полный проход запускается только если пользователь принял черновик
+      'refine': 'manual'
     }
 
     server_host = self.server_host_entry.get_text()
@@ -257,46 +280,105 @@ class KandinskyWindow(gtk.Window):
     r = requests.post('{}/inpaint'.format(server_host), json=request_json_data)
 
     text2img_endp_result = r.json()
+
+    # сервер перегружен: сообщаем пользователю, когда стоит повторить запрос
+    if text2img_endp_result['status'] == 'rejected':
+      gimp.message('Kandinsky server is busy ({}), try again in {} s'.format(
+        text2img_endp_result['reason'], text2img_endp_result['retry_after']))
+      self.image.undo_group_end()
+      return
+
+    # модель на сервере недоступна
+    if text2img_endp_result['status'] == 'error':
+      gimp.message('Kandinsky server error: {}'.format(text2img_endp_result['reason']))
+      self.image.undo_group_end()
+      return
+
     token = text2img_endp_result['token']
 
-    status_endp_result = {'status': 'unknown'}
-    if text2img_endp_result['status'] == 'initiated':
-      while status_endp_result['status'] != 'listening':
+    # слои с черновыми результатами, удаляются после получения полных
+    draft_layers = []
+    refining = text2img_endp_result['status'] == 'initiated'
+
+    # при включенном черновом режиме сервер сначала возвращает черновые
+    # результаты, а затем полные, поэтому ожидание повторяется
+    while refining:
+      status_endp_result = {'status': 'unknown'}
+      while status_endp_result['status'] not in ('listening', 'error'):
         r = requests.get('{}/progress'.format(server_host), json={'token':token})
         status_endp_result = r.json()
-        gimp.progress_update(sum(status_endp_result['progress']) / (decoder_steps + prior_steps * 2.))
+        # пока задача в очереди, показываем оценку времени до ее начала
+        if status_endp_result['status'] == 'queued':
+          pdb.gimp_progress_set_text('Queued, estimated start in {:.0f} s'.format(
+            max(0, status_endp_result['estimated_start'] - time.time())))
+        gimp.progress_update(sum(status_endp_result['progress']) / float(max(1, status_endp_result['total'])))
         time.sleep(0.1)
 
-    r = requests.get('{}/result'.format(server_host), json={'token':token})
-    raw_response = r.json()
+      # просим у сервера только область под выделением
+      r = requests.get('{}/result'.format(server_host), json={'token':token, 'sparse':True})
+      raw_response = r.json()
+      refining = raw_response.get('refining', False)
 
-    pdb.gimp_progress_end()
+      if raw_response['status'] == 'error':
+        gimp.message('Kandinsky server error: {}'.format(raw_response['reason']))
+      if raw_response['status'] != 'ready':
+        break
 
-    # снимаем выделение
-    gimp.pdb.gimp_selection_none(self.image)
+      for draft_layer in draft_layers:
+        pdb.gimp_image_remove_layer(self.image, draft_layer)
+      draft_layers = []
+
+      new_layer_width = raw_response['width']
+      new_layer_height = raw_response['height']
+      # смещение фрагмента относительно исходного слоя
+      new_layer_x = drawable_position[0] + raw_response.get('x', 0)
+      new_layer_y = drawable_position[1] + raw_response.get('y', 0)
+      new_layer_name = "KandinskyDraft" if raw_response.get('draft', False) else "KandinskyResult"
+
+      # итерируемся по полученным от сервера изображениям
+      for b64image in raw_response['images']:
+
+        new_layer_data = base64.b64decode(b64image)
 
-    new_layer_width = raw_response['width']
-    new_layer_height = raw_response['height']
+        new_layer = pdb.gimp_layer_new(
+          self.image, new_layer_width, new_layer_height, RGBA_IMAGE, new_layer_name, 100, NORMAL_MODE)
 
-    # итерируемся по полученным от сервера изображениям
-    for b64image in raw_response['images']:
+        pdb.gimp_image_insert_layer(self.image, new_layer, None, -1)
 
-      new_layer_data = base64.b64decode(b64image)
+        pdb.gimp_layer_set_offsets(new_layer, new_layer_x, new_layer_y)
 
-      new_layer = pdb.gimp_layer_new(
-        self.image, new_layer_width, new_layer_height, RGBA_IMAGE, "KandinskyResult", 100, NORMAL_MODE)
+        new_layer_pixel_rgn = new_layer.get_pixel_rgn(0, 0, new_layer_width, new_layer_height, True, True)
 
-      pdb.gimp_image_insert_layer(self.image, new_layer, None, -1)
+        new_layer_pixel_rgn[0:new_layer_width, 0:new_layer_height] = new_layer_data
 
-      pdb.gimp_layer_set_offsets(new_layer, drawable_position[0], drawable_position[1])
+        new_layer.flush()
+        new_layer.merge_shadow(True)
+        new_layer.update(0, 0, new_layer_width, new_layer_height)
 
-      new_layer_pixel_rgn = new_layer.get_pixel_rgn(0, 0, new_layer_width, new_layer_height, True, True)
+        if raw_response.get('draft', False):
+          draft_layers.append(new_layer)
 
-      new_layer_pixel_rgn[0:new_layer_width, 0:new_layer_height] = new_layer_data
+      # показываем черновые результаты и спрашиваем, запускать ли полный проход
+      if raw_response.get('draft', False):
+        pdb.gimp_displays_flush()
+        if self.ask_refine():
+          r = requests.post('{}/refine'.format(server_host), json={'token':token})
+          refine_endp_result = r.json()
+          refining = refine_endp_result['status'] == 'initiated'
+          if not refining:
+            gimp.message('Full-quality pass was not started: {}'.format(
+              refine_endp_result.get('reason', refine_endp_result['status'])))
+        else:
+          # черновик отклонен: удаляем его слои, полный проход не запускается
+          for draft_layer in draft_layers:
+            pdb.gimp_image_remove_layer(self.image, draft_layer)
+          draft_layers = []
+          refining = False
 
-      new_layer.flush()
-      new_layer.merge_shadow(True)
-      new_layer.update(0, 0, new_layer_width, new_layer_height)
+    pdb.gimp_progress_end()
+
+    # снимаем выделение
+    gimp.pdb.gimp_selection_none(self.image)
 
     # обнавляем интерфейс с новыми слоями
     pdb.gimp_displays_flush()
@@ -0,0 +1,164 @@
+"""Модель задержек инференса Kandinsky
+
+Файл содержит определение класса LatencyModel.
+Экземпляр класса хранит скользящие средние длительности одной итерации стадий
+prior и decoder, измеренные вспомогательным процессом по callback'ам пайплайнов,
+и по ним оценивает, сколько секунд GPU займет запрос.
+"""
+
+
+class LatencyModel:
+    """
+    Класс, описывающий модель длительности итераций инференса
+
+    Длительность итерации хранится отдельно для каждой стадии, разрешения и размера
+    батча. Для prior'а разрешение не учитывается. Если для ключа еще нет измерений,
+    используется ближайшее измерение той же стадии, масштабированное по объему работы,
+    а при полном отсутствии измерений - значения по умолчанию.
+
+    Аттрибуты
+    ---------
+    smoothing : float
+        Вес нового измерения в экспоненциальном скользящем среднем
+    defaults : dict
+        Длительности итерации по умолчанию для стадий при разрешении 512x512 и батче 1
+    stepLatency : dict
+        Скользящие средние длительности итерации по ключу (стадия, разрешение, батч)
+
+    Методы
+    ------
+    update(stage, width, height, batch_size, seconds_per_step)
+        Учитывает новое измерение длительности итерации
+    step_latency(stage, width, height, batch_size)
+        Возвращает оценку длительности одной итерации
+    estimate(request, progress=None, cached_prior=False)
+        Возвращает оценку длительности инференса запроса в секундах
+    """
+
+    # размер ячейки, с точностью до которой различаются разрешения
+    RESOLUTION_CELL = 64
+    # разрешение, к которому относятся значения по умолчанию
+    DEFAULT_PIXELS = 512 * 512
+
+    def __init__(self, prior_step=0.1, decoder_step=0.5, smoothing=0.2):
+        """
+        Параметры
+        ---------
+        prior_step : float
+            Длительность итерации prior'а по умолчанию, в секундах
+        decoder_step : float
+            Длительность итерации декодера по умолчанию (512x512, батч 1), в секундах
+        smoothing : float
+            Вес нового измерения в экспоненциальном скользящем среднем
+        """
+        self.smoothing = smoothing
+        self.defaults = {'prior': prior_step, 'decoder': decoder_step}
+        self.stepLatency = {}
+
+    def key(self, stage, width, height, batch_size):
+        """Возвращает ключ измерения
+
+        Параметры
+        ---------
+        stage : str
+            Стадия инференса: 'prior' или 'decoder'
+        width : int
+            Ширина изображения в пикселях
+        height : int
+            Высота изображения в пикселях
+        batch_size : int
+            Количество генерируемых изображений
+        """
+        if stage == 'prior':
+            return (stage, 0, 0, batch_size)
+        cell = self.RESOLUTION_CELL
+        return (stage, -(-width // cell), -(-height // cell), batch_size)
+
+    def work(self, key):
+        """Возвращает относительный объем работы итерации для ключа
+        """
+        stage, wCells, hCells, batch_size = key
+        if stage == 'prior':
+            return batch_size
+        cell = self.RESOLUTION_CELL
+        return wCells * hCells * cell * cell * batch_size
+
+    def update(self, stage, width, height, batch_size, seconds_per_step):
+        """Учитывает новое измерение длительности итерации
+
+        Параметры
+        ---------
+        stage : str
+            Стадия инференса: 'prior' или 'decoder'
+        width : int
+            Ширина изображения в пикселях
+        height : int
+            Высота изображения в пикселях
+        batch_size : int
+            Количество генерируемых изображений
+        seconds_per_step : float
+            Измеренная длительность одной итерации
+        """
+        key = self.key(stage, width, height, batch_size)
+        if key in self.stepLatency:
+            self.stepLatency[key] += self.smoothing * (seconds_per_step - self.stepLatency[key])
+        else:
+            self.stepLatency[key] = seconds_per_step
+
+    def step_latency(self, stage, width, height, batch_size):
+        """Возвращает оценку длительности одной итерации в секундах
+
+        Параметры
+        ---------
+        stage : str
+            Стадия инференса: 'prior' или 'decoder'
+        width : int
+            Ширина изображения в пикселях
+        height : int
+            Высота изображения в пикселях
+        batch_size : int
+            Количество генерируемых изображений
+        """
+        key = self.key(stage, width, height, batch_size)
+        if key in self.stepLatency:
+            return self.stepLatency[key]
+
+        work = self.work(key)
+        measured = [k for k in self.stepLatency if k[0] == stage]
+        # масштабируем ближайшее по объему работы измерение той же стадии
+        if measured:
+            nearest = min(measured, key=lambda k: abs(self.work(k) - work))
+            return self.stepLatency[nearest] * work / self.work(nearest)
+
+        if stage == 'prior':
+            return self.defaults[stage] * batch_size
+        return self.defaults[stage] * work / self.DEFAULT_PIXELS
+
+    def estimate(self, request, progress=None, cached_prior=False):
+        """Возвращает оценку длительности инференса запроса в секундах
+
+        Параметры
+        ---------
+        request : dict
+            Словарь с данными для инференса (в формате эндпоинта /inpaint)
+        progress : list
+            Количество уже выполненных итераций каждой из трех стадий
+        cached_prior : bool
+            Флаг того, что эмбединги prior'а уже посчитаны и будут взяты из кэша
+        """
+        progress = progress or [0, 0, 0]
+        batch_size = request['image_number']
+        width, height = request['width'], request['height']
+        decoder_steps = request['decoder_steps']
+        if request.get('draft', False):
+            width = max(64, int(width * request['draft_scale']))
+            height = max(64, int(height * request['draft_scale']))
+            decoder_steps = request['draft_decoder_steps']
+
+        seconds = 0.
+        if not cached_prior:
+            prior_steps = max(0, request['prior_steps'] - progress[0]) + max(0, request['prior_steps'] - progress[1])
+            seconds += prior_steps * self.step_latency('prior', width, height, batch_size)
+        decoder_steps = max(0, decoder_steps - progress[2])
+        seconds += decoder_steps * self.step_latency('decoder', width, height, batch_size)
+        return seconds
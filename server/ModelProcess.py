@@ -3,11 +3,12 @@
 Файл содержит определение класса ModelProcess.
 Экземпляр класса описывает вспомогательный процесс сервера, который отвечает за
 работу с моделью: ее запуск и инференс. Процесс также "общается" с основным
-процессом через очереди queueM и queueF и переменные modelIsInferencing и modelProgress.
+процессом через очереди queueM, queueF и queueL и переменные modelIsInferencing и modelProgress.
 """
 
 import multiprocessing
 import queue
+import time
 
 from PIL import Image
 import base64
@@ -28,10 +29,14 @@ class ModelProcess(multiprocessing.Process):
         Общая для процессов сервера переменная, предназанчена для фиксирования активности модели
     modelProgress : multiprocessing.Value
         Общая для процессов сервера переменная, хранит прогресс модели
+    queueL : multiprocessing.Queue
+        Очередь для отправки измеренной длительности итераций основному процессу
     exit : multiprocessing.Event
         Вспомогательная переменная, предназначена для выхода из цикла в методе run
     model : ModifiedKandinskyV22Inpaint
         Экземпляр модели
+    embeddingsCache : tuple
+        Кэш эмбедингов prior'а последнего запроса
 
     Методы
     ------
@@ -39,6 +44,8 @@ class ModelProcess(multiprocessing.Process):
         Преобразовывает бинарную строку в PIL Image
     inpainting(request)
         Запускает инференс модели
+    report_step_latency(stepTimestamps, width, height, batch_size)
+        Отправляет основному процессу среднюю длительность итераций
     init_model()
         Инициализирует экземпляр модели
     delete_model()
@@ -49,7 +56,7 @@ class ModelProcess(multiprocessing.Process):
         Выполняет заключительные действия при остановке процесса
     """
 
-    def __init__(self, queueM, queueF, modelIsInferencing, modelProgress):
+    def __init__(self, queueM, queueF, modelIsInferencing, modelProgress, queueL):
         """
         Параметры
         ---------
@@ -61,12 +68,15 @@ class ModelProcess(multiprocessing.Process):
             Общая для процессов сервера переменная, предназанчена для фиксирования активности модели
         modelProgress : multiprocessing.Value
             Общая для процессов сервера переменная, хранит прогресс модели
+        queueL : multiprocessing.Queue
+            Очередь для отправки измеренной длительности итераций основному процессу
         """
         super().__init__()
         self.queueM = queueM
         self.queueF = queueF
         self.modelIsInferencing = modelIsInferencing
         self.modelProgress = modelProgress
+        self.queueL = queueL
         self.exit = multiprocessing.Event()
 
     def decode_gimp_image(self, img, width, height, has_alpha=False):
@@ -96,6 +106,11 @@ class ModelProcess(multiprocessing.Process):
 
     def inpainting(self, request):
         """Запускает инференс модели
+
+        Если в запросе выставлен флаг draft, то выполняется быстрый черновой проход
+        с уменьшенным числом итераций декодера и уменьшенным разрешением. Эмбединги
+        prior'а кэшируются, поэтому последующий полный проход с тем же seed'ом
+        prior не запускает.
     
         Параметры
         ---------
@@ -109,11 +124,31 @@ class ModelProcess(multiprocessing.Process):
             self.decode_gimp_image(request['mask'], request['width'], request['height'])
         )
 
-        print("[ModelProcess]: start inpainting inferencing")
+        # исходная маска нужна основному процессу для вырезания результата
+        resultMask = mask
+
+        draft = request.get('draft', False)
+        seed = request.get('seed')
+        width, height = request['width'], request['height']
+        decoder_steps = request['decoder_steps']
+
+        # для чернового прохода уменьшаем разрешение и число итераций декодера
+        if draft:
+            width = max(64, int(request['width'] * request['draft_scale']))
+            height = max(64, int(request['height'] * request['draft_scale']))
+            decoder_steps = request['draft_decoder_steps']
+            image = image.resize((width, height), Image.BICUBIC)
+            mask = mask.resize((width, height), Image.BICUBIC)
+
+        print("[ModelProcess]: start {} inpainting inferencing".format("draft" if draft else "full"))
+
+        # моменты завершения итераций каждой из стадий
+        stepTimestamps = ([], [], [])
 
         # определяем внутреннюю структуру callback'ов
         def create_pipe_callback(stage):
             def pipe_callback(pipe, step_index, timestep, callback_kwargs):
+                stepTimestamps[stage].append(time.perf_counter())
                 with self.modelProgress.get_lock():
                     self.modelProgress[stage] = step_index + 1
                 return callback_kwargs
@@ -126,37 +161,95 @@ class ModelProcess(multiprocessing.Process):
             "decoder_callback": create_pipe_callback(2)
         }
 
+        # эмбединги prior'а не зависят от разрешения и числа итераций декодера,
+        # поэтому их можно переиспользовать между черновым и полным проходами
+        embeddingsKey = (
+            request['prompt'], request['prior_steps'], request['cgs_scale'],
+            request['image_number'], seed)
+        if seed is not None and self.embeddingsCache is not None and self.embeddingsCache[0] == embeddingsKey:
+            embeddings = self.embeddingsCache[1]
+            with self.modelProgress.get_lock():
+                self.modelProgress[0] = request['prior_steps']
+                self.modelProgress[1] = request['prior_steps']
+        else:
+            embeddings = self.model.generate_embeddings(
+                [request['prompt']] * request['image_number'],
+                prior_steps=request['prior_steps'],
+                prior_guidance_scale=request['cgs_scale'],
+                negative_prior_prompt=[''] * request['image_number'],
+                negative_decoder_prompt=[''] * request['image_number'],
+                img_emb_callback=pipe_callbacks['img_emb_callback'],
+                neg_emb_callback=pipe_callbacks['neg_emb_callback'],
+                seed=seed)
+            self.embeddingsCache = (embeddingsKey, embeddings)
+
         images = self.model.generate_inpainting(
             [request['prompt']] * request['image_number'],
             [image] * request['image_number'], 
             [mask] * request['image_number'],
-            decoder_steps=request['decoder_steps'],
+            decoder_steps=decoder_steps,
             prior_steps=request['prior_steps'],
             decoder_guidance_scale=request['cgs_scale'],
             prior_guidance_scale=request['cgs_scale'],
-            h=request['height'],
-            w=request['width'],
+            h=height,
+            w=width,
             negative_prior_prompt=[''] * request['image_number'],
             negative_decoder_prompt=[''] * request['image_number'],
+            seed=seed,
+            embeddings=embeddings,
             **pipe_callbacks)
 
+        self.report_step_latency(stepTimestamps, width, height, request['image_number'])
+
+        # черновые изображения возвращаем в исходном разрешении, чтобы клиенту
+        # не нужно было их масштабировать
+        if draft:
+            images = [img.resize((request['width'], request['height']), Image.BICUBIC) for img in images]
+
         print("[ModelProcess]: end of inpainting inferencing")
 
+        # маску возвращаем вместе с результатом, чтобы основной процесс мог
+        # отдать клиенту только выделенную область изображений
         return {
             'images': images,
+            'mask': resultMask,
+            'draft': draft,
             'width': request['width'],
             'height': request['height']
         }
 
+    def report_step_latency(self, stepTimestamps, width, height, batch_size):
+        """Отправляет основному процессу среднюю длительность итерации стадий prior и decoder
+
+        Параметры
+        ---------
+        stepTimestamps : tuple
+            Моменты завершения итераций каждой из трех стадий инференса
+        width : int
+            Ширина изображения, с которой работал декодер
+        height : int
+            Высота изображения, с которой работал декодер
+        batch_size : int
+            Количество генерируемых изображений
+        """
+        # первая итерация стадии не учитывается, так как ее начало не зафиксировано
+        for stage, timestamps in zip(('prior', 'prior', 'decoder'), stepTimestamps):
+            if len(timestamps) >= 2:
+                secondsPerStep = (timestamps[-1] - timestamps[0]) / (len(timestamps) - 1)
+                self.queueL.put((stage, width, height, batch_size, secondsPerStep))
+
     def init_model(self):
         """Инициализирует модель ModifiedKandinskyV22Inpaint
         """
         self.model = ModifiedKandinskyV22Inpaint('cuda')
+        # кэш эмбедингов prior'а последнего запроса: (ключ, эмбединги)
+        self.embeddingsCache = None
         print("[ModelProcess]: Model is initiated")
 
     def delete_model(self):
         """Удаляет модель
         """
+        del self.embeddingsCache
         del self.model
 
     def run(self):
@@ -172,7 +265,13 @@ class ModelProcess(multiprocessing.Process):
                 if inferenceType == 'inpaint':
                     with self.modelIsInferencing.get_lock():
                         self.modelIsInferencing.value = True
-                    modelResult = self.inpainting(data)
+                    # ошибка одного запроса (например, нехватка памяти GPU или некорректные
+                    # данные) не должна завершать процесс, отдаем ее основному процессу
+                    try:
+                        modelResult = self.inpainting(data)
+                    except Exception as e:
+                        print("[ModelProcess]: Inference failed: {!r}".format(e))
+                        modelResult = {'error': repr(e)}
                     self.queueM.put(modelResult)
                     with self.modelIsInferencing.get_lock():
                         self.modelIsInferencing.value = False
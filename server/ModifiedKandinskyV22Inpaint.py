@@ -32,42 +32,49 @@ class ModifiedKandinskyV22Inpaint(Kandinsky2_2):
         self.decoder = self.decoder.to(self.device)
         self.decoder.enable_sequential_cpu_offload()
 
-    def generate_inpainting(
+    def make_generator(self, seed):
+        """Создает генератор случайных чисел для фиксированного seed'а
+
+        Параметры
+        ---------
+        seed : int или None
+            Значение seed'а. Если None, то генератор не создается
+        """
+        if seed is None:
+            return None
+        return torch.Generator().manual_seed(seed)
+
+    def generate_embeddings(
         self,
         prompt,
-        pil_img,
-        img_mask,
         batch_size=1,
-        decoder_steps=50,
         prior_steps=25,
-        decoder_guidance_scale=4,
         prior_guidance_scale=4,
-        h=512,
-        w=512,
         negative_prior_prompt="",
         negative_decoder_prompt="",
         img_emb_callback=None,
         neg_emb_callback=None,
-        decoder_callback=None
+        seed=None
     ):
-    """Генерирует inpainting
-
-    Новые параметры
-    ---------------
-    img_emb_callback : function
-        Функция, получающая прогресс формирования положительных эмбедингов
-    neg_emb_callback : function
-        Функция, получающая прогресс формирования отрицательных эмбедингов
-    decoder_callback : function
-        Функция, получающая прогресс работы U-net'a и декодера
-    """
-        
+        """Генерирует положительные и отрицательные эмбединги prior'а
+
+        Параметры
+        ---------
+        img_emb_callback : function
+            Функция, получающая прогресс формирования положительных эмбедингов
+        neg_emb_callback : function
+            Функция, получающая прогресс формирования отрицательных эмбедингов
+        seed : int
+            Seed для воспроизводимой генерации
+        """
+
         img_emb = self.prior(
             prompt=prompt,
             num_inference_steps=prior_steps,
             num_images_per_prompt=batch_size,
             guidance_scale=prior_guidance_scale,
             negative_prompt=negative_prior_prompt,
+            generator=self.make_generator(seed),
             callback_on_step_end=img_emb_callback)
 
         negative_emb = self.prior(
@@ -75,6 +82,7 @@ class ModifiedKandinskyV22Inpaint(Kandinsky2_2):
             num_inference_steps=prior_steps,
             num_images_per_prompt=batch_size,
             guidance_scale=prior_guidance_scale,
+            generator=self.make_generator(seed),
             callback_on_step_end=neg_emb_callback)
 
         if negative_decoder_prompt == "":
@@ -82,8 +90,61 @@ class ModifiedKandinskyV22Inpaint(Kandinsky2_2):
         else:
             negative_emb = negative_emb.image_embeds
 
+        return img_emb.image_embeds, negative_emb
+
+    def generate_inpainting(
+        self,
+        prompt,
+        pil_img,
+        img_mask,
+        batch_size=1,
+        decoder_steps=50,
+        prior_steps=25,
+        decoder_guidance_scale=4,
+        prior_guidance_scale=4,
+        h=512,
+        w=512,
+        negative_prior_prompt="",
+        negative_decoder_prompt="",
+        img_emb_callback=None,
+        neg_emb_callback=None,
+        decoder_callback=None,
+        seed=None,
+        embeddings=None
+    ):
+        """Генерирует inpainting
+
+        Новые параметры
+        ---------------
+        img_emb_callback : function
+            Функция, получающая прогресс формирования положительных эмбедингов
+        neg_emb_callback : function
+            Функция, получающая прогресс формирования отрицательных эмбедингов
+        decoder_callback : function
+            Функция, получающая прогресс работы U-net'a и декодера
+        seed : int
+            Seed для воспроизводимой генерации
+        embeddings : tuple
+            Заранее посчитанные эмбединги prior'а (результат generate_embeddings).
+            Если переданы, prior не запускается
+        """
+
+        if embeddings is None:
+            embeddings = self.generate_embeddings(
+                prompt,
+                batch_size=batch_size,
+                prior_steps=prior_steps,
+                prior_guidance_scale=prior_guidance_scale,
+                negative_prior_prompt=negative_prior_prompt,
+                negative_decoder_prompt=negative_decoder_prompt,
+                img_emb_callback=img_emb_callback,
+                neg_emb_callback=neg_emb_callback,
+                seed=seed)
+
+        image_embeds, negative_emb = embeddings
+
         images = self.decoder(
-            image_embeds=img_emb.image_embeds, 
+            image_embeds=image_embeds, 
             negative_image_embeds=negative_emb,
             num_inference_steps=decoder_steps,
             height=h,
@@ -91,6 +152,7 @@ class ModifiedKandinskyV22Inpaint(Kandinsky2_2):
             guidance_scale=decoder_guidance_scale,
             image=pil_img,
             mask_image=img_mask,
+            generator=self.make_generator(seed),
             callback_on_step_end=decoder_callback).images
 
-        return images
\ No newline at end of file
+        return images
@@ -0,0 +1,323 @@
+"""Пакетный инференс Kandinsky без GIMP
+
+Файл содержит консольную утилиту, которая выполняет inpainting для набора пар
+изображение/маска. Пары берутся либо из двух папок (файлы с одинаковыми именами),
+либо из JSONL-манифеста, каждая строка которого описывает одну задачу:
+
+    {"id": "cat", "image": "cat.png", "mask": "cat_mask.png", "prompt": "a cat"}
+
+Работа разделена на три стадии, связанные ограниченными очередями:
+загрузка и декодирование изображений, инференс модели, кодирование и запись
+результатов. Благодаря этому подготовка данных на CPU идет параллельно с
+инференсом. Уже посчитанные задачи пропускаются, что позволяет продолжить
+обработку после прерывания.
+
+Запуск из папки server:
+
+    python batch.py --images ./images --masks ./masks --output ./out --prompt "..."
+    python batch.py --manifest requests.jsonl --output ./out
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+from PIL import Image
+
+from ModifiedKandinskyV22Inpaint import ModifiedKandinskyV22Inpaint
+
+# параметры генерации, которые можно переопределить в строке манифеста
+GENERATION_PARAMETERS = ('prompt', 'decoder_steps', 'prior_steps', 'cgs_scale', 'image_number', 'seed')
+
+# маркер конца очереди
+STOP = None
+
+
+class BatchStats:
+    """
+    Класс, описывающий статистику пакетной обработки
+
+    Хранится вне стадии инференса, чтобы отчет был доступен и после прерывания.
+
+    Аттрибуты
+    ---------
+    processed : int
+        Количество сгенерированных изображений
+    failed : list
+        Идентификаторы задач, завершившихся ошибкой
+    start : float
+        Момент начала обработки
+
+    Методы
+    ------
+    elapsed()
+        Возвращает время с начала обработки в секундах
+    rate()
+        Возвращает скорость обработки в изображениях в секунду
+    """
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = []
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        """Возвращает время с начала обработки в секундах
+        """
+        return time.perf_counter() - self.start
+
+    def rate(self):
+        """Возвращает скорость обработки в изображениях в секунду
+        """
+        elapsed = self.elapsed()
+        return self.processed / elapsed if elapsed > 0 else 0.
+
+
+def read_jobs(args):
+    """Возвращает генератор задач из манифеста или из пары папок
+
+    Параметры
+    ---------
+    args : argparse.Namespace
+        Аргументы командной строки
+    """
+    defaults = {
+        'prompt': args.prompt,
+        'decoder_steps': args.decoder_steps,
+        'prior_steps': args.prior_steps,
+        'cgs_scale': args.cgs_scale,
+        'image_number': args.image_number,
+        'seed': args.seed
+    }
+
+    if args.manifest is not None:
+        base_dir = os.path.dirname(os.path.abspath(args.manifest))
+        with open(args.manifest, encoding='utf-8') as manifest:
+            for number, line in enumerate(manifest, 1):
+                if not line.strip():
+                    continue
+                # некорректная строка манифеста не должна останавливать всю обработку
+                try:
+                    entry = json.loads(line)
+                    job = dict(defaults)
+                    job.update({k: entry[k] for k in GENERATION_PARAMETERS if k in entry})
+                    job['image'] = os.path.join(base_dir, entry['image'])
+                    job['mask'] = os.path.join(base_dir, entry['mask'])
+                    job['id'] = str(entry.get('id', os.path.splitext(os.path.basename(entry['image']))[0]))
+                except (ValueError, KeyError, TypeError) as e:
+                    print("[Batch]: Invalid manifest line {}: {!r}, skipping".format(number, e))
+                    continue
+                yield job
+    else:
+        for name in sorted(os.listdir(args.images)):
+            mask_path = os.path.join(args.masks, name)
+            if not os.path.isfile(mask_path):
+                print("[Batch]: No mask for {}, skipping".format(name))
+                continue
+            job = dict(defaults)
+            job['image'] = os.path.join(args.images, name)
+            job['mask'] = mask_path
+            job['id'] = os.path.splitext(name)[0]
+            yield job
+
+
+def output_paths(job, output_dir):
+    """Возвращает пути к файлам результатов задачи
+
+    Параметры
+    ---------
+    job : dict
+        Задача
+    output_dir : str
+        Папка для результатов
+    """
+    return [
+        os.path.join(output_dir, '{}_{}.png'.format(job['id'], i))
+        for i in range(job['image_number'])]
+
+
+def load_stage(jobs, output_dir, loadQueue, stopEvent):
+    """Стадия загрузки: читает и декодирует изображения и маски
+
+    Параметры
+    ---------
+    jobs : iterable
+        Задачи для обработки
+    output_dir : str
+        Папка для результатов, нужна для пропуска уже посчитанных задач
+    loadQueue : queue.Queue
+        Очередь для передачи подготовленных задач на инференс
+    stopEvent : threading.Event
+        Флаг остановки
+    """
+    # маркер конца ставится в любом случае, иначе стадия инференса будет ждать вечно
+    try:
+        for job in jobs:
+            if stopEvent.is_set():
+                break
+            try:
+                # результаты уже записаны при прошлом запуске
+                if all(os.path.isfile(path) for path in output_paths(job, output_dir)):
+                    print("[Batch]: {} is already done, skipping".format(job['id']))
+                    continue
+                image = Image.open(job['image']).convert('RGB')
+                # маска в том же формате, что присылает клиент: оттенки серого в RGB
+                mask = Image.open(job['mask']).convert('L').convert('RGB')
+                if mask.size != image.size:
+                    mask = mask.resize(image.size, Image.BICUBIC)
+            except Exception as e:
+                print("[Batch]: Failed to load {}: {!r}".format(job['id'], e))
+                continue
+            loadQueue.put((job, image, mask))
+    except Exception as e:
+        print("[Batch]: Failed to read jobs: {!r}".format(e))
+    finally:
+        loadQueue.put(STOP)
+
+
+def write_stage(output_dir, writeQueue, stats):
+    """Стадия записи: кодирует результаты в PNG и сохраняет их на диск
+
+    Параметры
+    ---------
+    output_dir : str
+        Папка для результатов
+    writeQueue : queue.Queue
+        Очередь с результатами инференса
+    stats : BatchStats
+        Статистика обработки, готовыми считаются только записанные изображения
+    """
+    while True:
+        item = writeQueue.get()
+        if item is STOP:
+            break
+        job, images = item
+        # ошибка записи не должна останавливать стадию, иначе очередь переполнится
+        try:
+            for path, image in zip(output_paths(job, output_dir), images):
+                # пишем во временный файл, чтобы прерванная запись не считалась готовым результатом
+                tmp_path = path + '.tmp'
+                image.save(tmp_path, format='PNG')
+                os.replace(tmp_path, path)
+                stats.processed += 1
+        except Exception as e:
+            print("[Batch]: Failed to write {}: {!r}".format(job['id'], e))
+            stats.failed.append(job['id'])
+            continue
+        print("[Batch]: {} is done, {} images, {:.3f} images/s".format(
+            job['id'], stats.processed, stats.rate()))
+
+
+def infer_stage(model, loadQueue, writeQueue, stopEvent, stats):
+    """Стадия инференса: запускает модель для подготовленных задач
+
+    Параметры
+    ---------
+    model : ModifiedKandinskyV22Inpaint
+        Экземпляр модели
+    loadQueue : queue.Queue
+        Очередь с подготовленными задачами
+    writeQueue : queue.Queue
+        Очередь для передачи результатов на запись
+    stopEvent : threading.Event
+        Флаг остановки
+    stats : BatchStats
+        Статистика обработки
+    """
+
+    while not stopEvent.is_set():
+        item = loadQueue.get()
+        if item is STOP:
+            break
+        job, image, mask = item
+        width, height = image.size
+
+        print("[Batch]: start inpainting of {}".format(job['id']))
+
+        # ошибка одной задачи (например, нехватка памяти GPU) не прерывает всю обработку
+        try:
+            images = model.generate_inpainting(
+                [job['prompt']] * job['image_number'],
+                [image] * job['image_number'],
+                [mask] * job['image_number'],
+                decoder_steps=job['decoder_steps'],
+                prior_steps=job['prior_steps'],
+                decoder_guidance_scale=job['cgs_scale'],
+                prior_guidance_scale=job['cgs_scale'],
+                h=height,
+                w=width,
+                negative_prior_prompt=[''] * job['image_number'],
+                negative_decoder_prompt=[''] * job['image_number'],
+                seed=job['seed'])
+        except Exception as e:
+            print("[Batch]: Failed to inpaint {}: {!r}".format(job['id'], e))
+            stats.failed.append(job['id'])
+            continue
+
+        writeQueue.put((job, images))
+
+
+def parse_args():
+    """Разбирает аргументы командной строки
+    """
+    parser = argparse.ArgumentParser(description='Пакетный inpainting моделью Kandinsky 2.2')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='JSONL-манифест с задачами')
+    source.add_argument('--images', help='папка с исходными изображениями')
+    parser.add_argument('--masks', help='папка с масками (имена файлов как у изображений)')
+    parser.add_argument('--output', required=True, help='папка для результатов')
+    parser.add_argument('--prompt', default='', help='промпт по умолчанию')
+    parser.add_argument('--decoder-steps', type=int, default=20)
+    parser.add_argument('--prior-steps', type=int, default=20)
+    parser.add_argument('--cgs-scale', type=float, default=4)
+    parser.add_argument('--image-number', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--queue-size', type=int, default=4, help='размер очередей между стадиями')
+    parser.add_argument('--device', default='cuda')
+    args = parser.parse_args()
+    if args.images is not None and args.masks is None:
+        parser.error('--masks is required together with --images')
+    return args
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output, exist_ok=True)
+
+    loadQueue = queue.Queue(maxsize=args.queue_size)
+    writeQueue = queue.Queue(maxsize=args.queue_size)
+    stopEvent = threading.Event()
+    stats = BatchStats()
+
+    model = ModifiedKandinskyV22Inpaint(args.device)
+    print("[Batch]: Model is initiated")
+
+    loader = threading.Thread(
+        target=load_stage, args=(read_jobs(args), args.output, loadQueue, stopEvent), daemon=True)
+    writer = threading.Thread(
+        target=write_stage, args=(args.output, writeQueue, stats))
+    loader.start()
+    writer.start()
+
+    try:
+        infer_stage(model, loadQueue, writeQueue, stopEvent, stats)
+    except KeyboardInterrupt:
+        print("[Batch]: Caught KeyboardInterrupt, finishing pending writes ...")
+        stopEvent.set()
+    finally:
+        # дожидаемся записи уже посчитанных результатов
+        writeQueue.put(STOP)
+        writer.join()
+
+    print("[Batch]: {} images in {:.1f} s, {:.3f} images/s".format(
+        stats.processed, stats.elapsed(), stats.rate()))
+    if stats.failed:
+        print("[Batch]: {} jobs failed and can be retried by running again: {}".format(
+            len(stats.failed), ', '.join(stats.failed)))
+
+
+if __name__ == '__main__':
+    main()
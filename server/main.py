@@ -1,18 +1,32 @@
 """Основной процесс серверной части плагина Kandinsky
 
 Файл содержит реализацию обработки запросов клиентской части плагина с использованием Flask.
+Запросы на инференс ставятся в очередь и по одному передаются вспомогательному процессу.
+Перед постановкой в очередь запрос проходит контроль допуска: по измеренной длительности
+итераций оценивается его стоимость в секундах GPU, и если очередь или квота клиента
+переполнены, запрос сразу отклоняется с подсказкой, через сколько секунд его стоит повторить.
 """
 
 from flask import Flask, request
 
 import uuid
+import random
 
 from ModelProcess import ModelProcess
+from LatencyModel import LatencyModel
 import multiprocessing
 import queue
 
 import base64
 from array import array
+from PIL import Image
+
+import collections
+import math
+import os
+import threading
+import time
+import traceback
 
 app = Flask(__name__)
 
@@ -20,98 +34,417 @@ app = Flask(__name__)
 queueM = multiprocessing.Queue(maxsize=1)
 # очередь для получения данных для инференса от основного процесса
 queueF = multiprocessing.Queue(maxsize=1)
+# очередь для получения измеренной длительности итераций от вспомогательного процесса
+queueL = multiprocessing.Queue()
 
 # общая для процессов сервера переменная, предназанчена для фиксирования активности модели
 modelIsInferencing = multiprocessing.Value('i', 0)
 # общая для процессов сервера переменная, хранит прогресс модели
 modelProgress = multiprocessing.Array('i', 3)
 
+# во сколько раз черновой проход уменьшает число итераций декодера
+DRAFT_STEPS_DIVIDER = 4
+# коэффициент масштабирования разрешения для чернового прохода
+DRAFT_SCALE = 0.5
+
+# максимальная суммарная оценка секунд GPU для задач в очереди (включая текущую)
+MAX_QUEUED_GPU_SECONDS = float(os.environ.get('KANDINSKY_MAX_QUEUED_GPU_SECONDS', 600))
+# максимальное число незавершенных задач одного клиента (в очереди, в работе и не забранных)
+MAX_JOBS_PER_CLIENT = int(os.environ.get('KANDINSKY_MAX_JOBS_PER_CLIENT', 2))
+# время в секундах, после которого незабранные результаты, черновики и ошибки удаляются
+RESULT_TTL = float(os.environ.get('KANDINSKY_RESULT_TTL', 600))
+# число ошибок подряд в фоновом потоке, после которого сервер перестает принимать задачи
+MAX_DISPATCH_ERRORS = 3
+
+# блокировка для состояния очереди, обработчики Flask выполняются в разных потоках
+jobsLock = threading.Lock()
+
+# функция для вычисления общего числа итераций прохода
+def total_steps(plugin_request):
+    decoder_steps = plugin_request['draft_decoder_steps'] if plugin_request.get('draft', False) else plugin_request['decoder_steps']
+    return decoder_steps + plugin_request['prior_steps'] * 2
+
+# функция для создания задачи очереди
+def create_job(token, client, plugin_request, cached_prior=False):
+    job = {
+        'token': token,
+        'client': client,
+        'request': plugin_request,
+        'cached_prior': cached_prior,
+        'estimate': latencyModel.estimate(plugin_request, cached_prior=cached_prior),
+        # оценка полного прохода, который будет запущен сразу после чернового
+        'followup': 0.
+    }
+    if plugin_request.get('draft', False) and plugin_request.get('refine') == 'auto':
+        job['followup'] = latencyModel.estimate(dict(plugin_request, draft=False), cached_prior=True)
+    return job
+
+# функция для отправки задачи на инференс вспомогательному процессу
+def start_inference(job):
+    global activeJob
+    global currentTotalSteps
+    # обнуляем прогресс модели
+    with modelProgress.get_lock():
+        for i in range(3):
+            modelProgress[i] = 0
+    queueF.put(('inpaint', job['request']))
+    with modelIsInferencing.get_lock():
+        modelIsInferencing.value = True
+    activeJob = job
+    # запоминаем общее число итераций текущего прохода для клиента
+    currentTotalSteps = total_steps(job['request'])
+
+# функция, оценивающая оставшееся время работы текущей задачи в секундах
+def active_remaining():
+    if activeJob is None:
+        return 0.
+    progress = [modelProgress[i] for i in range(3)]
+    return latencyModel.estimate(activeJob['request'], progress, activeJob['cached_prior']) + activeJob['followup']
+
+# функция, которая передает вспомогательному процессу следующую задачу из очереди,
+# если модель свободна
+def dispatch():
+    if activeJob is None and pendingJobs and modelFailure is None:
+        start_inference(pendingJobs.popleft())
+
+# функция для сохранения результата текущей задачи
+def store_result(modelResult):
+    global activeJob
+    job = activeJob
+    activeJob = None
+    if job is None:
+        return
+    # инференс завершился ошибкой: помечаем только эту задачу, модель продолжает работу
+    if 'error' in modelResult:
+        failedJobs[job['token']] = (modelResult['error'], time.time())
+        return
+    # результаты хранятся по проходам, чтобы полный проход не затер незабранный черновой
+    results.setdefault(job['token'], collections.deque()).append((job, modelResult, time.time()))
+    # автоматический полный проход после чернового продолжает уже принятую задачу,
+    # поэтому ставится в начало очереди (в отличие от /refine)
+    if modelResult['draft'] and job['request'].get('refine') == 'auto':
+        pendingJobs.appendleft(create_job(
+            job['token'], job['client'], dict(job['request'], draft=False), cached_prior=True))
+
+# функция, помечающая текущую и все ожидающие задачи как завершившиеся ошибкой
+def fail_jobs(reason):
+    global activeJob
+    jobs = list(pendingJobs) + ([activeJob] if activeJob is not None else [])
+    for job in jobs:
+        failedJobs[job['token']] = (reason, time.time())
+    pendingJobs.clear()
+    activeJob = None
+
+# функция, удаляющая незабранные результаты, черновики и ошибки старше RESULT_TTL,
+# чтобы клиент, который их не забрал, не держал память и квоту вечно
+def evict_expired():
+    expired = time.time() - RESULT_TTL
+    for token in [t for t, passes in results.items() if passes[-1][2] < expired]:
+        print("[FlaskProcess]: Result of {} was not collected, dropping it".format(token))
+        del results[token]
+    for token in [t for t, (_, storedAt) in draftJobs.items() if storedAt < expired]:
+        del draftJobs[token]
+    for token in [t for t, (_, storedAt) in failedJobs.items() if storedAt < expired]:
+        del failedJobs[token]
+
+# основной цикл фонового потока: забирает результаты и измерения у вспомогательного
+# процесса и сразу передает ему следующую задачу, не дожидаясь запросов клиентов
+def dispatch_loop():
+    global modelFailure
+    consecutiveErrors = 0
+    while True:
+        # исключение не должно молча останавливать поток, иначе задачи перестанут выполняться
+        try:
+            try:
+                modelResult = queueM.get(timeout=1)
+            except queue.Empty:
+                modelResult = None
+            with jobsLock:
+                # результат сохраняется первым, чтобы последующая ошибка его не потеряла
+                if modelResult is not None:
+                    store_result(modelResult)
+                while True:
+                    try:
+                        measurement = queueL.get(block=False)
+                    except queue.Empty:
+                        break
+                    # некорректное измерение пропускаем, оно не должно мешать очереди
+                    try:
+                        latencyModel.update(*measurement)
+                    except Exception as e:
+                        print("[FlaskProcess]: Bad latency measurement {!r}: {!r}".format(measurement, e))
+                if modelResult is None and modelFailure is None and not modelProcess.is_alive():
+                    # вспомогательный процесс завершился, задачи больше некому выполнять
+                    modelFailure = 'model_unavailable'
+                    print("[FlaskProcess]: ModelProcess is dead, failing all jobs")
+                    fail_jobs(modelFailure)
+                evict_expired()
+                dispatch()
+            consecutiveErrors = 0
+        except Exception:
+            consecutiveErrors += 1
+            print("[FlaskProcess]: Error in the dispatcher thread:")
+            traceback.print_exc()
+            # ошибка повторяется: очередь дальше не движется, сообщаем об этом клиентам
+            if consecutiveErrors >= MAX_DISPATCH_ERRORS:
+                with jobsLock:
+                    if modelFailure is None:
+                        modelFailure = 'dispatcher_failed'
+                        print("[FlaskProcess]: Dispatcher keeps failing, failing all jobs")
+                        fail_jobs(modelFailure)
+
+# функция, возвращающая оценки начала и конца задачи как unix-время
+def job_eta(token):
+    now = time.time()
+    if activeJob is not None and activeJob['token'] == token:
+        return now, now + active_remaining()
+    start = now + active_remaining()
+    for job in pendingJobs:
+        if job['token'] == token:
+            return start, start + job['estimate'] + job['followup']
+        start += job['estimate'] + job['followup']
+    return None, None
+
+# функция для формирования ответа с отказом в постановке в очередь
+def reject(reason, retry_after):
+    retry_after = max(1, int(math.ceil(retry_after)))
+    return {
+        'status': 'rejected',
+        'reason': reason,
+        'retry_after': retry_after
+    }, 429, {'Retry-After': str(retry_after)}
+
+# функция контроля допуска задачи в очередь: возвращает ответ с отказом или None
+def admit(job):
+    # вспомогательный процесс завершился, принимать задачи бессмысленно
+    if modelFailure is not None:
+        return { 'status': 'error', 'reason': modelFailure }, 503
+
+    client = job['client']
+    # задачи клиента: в работе, в очереди и с незабранными результатами
+    clientJobs = [j for j in pendingJobs if j['client'] == client]
+    if activeJob is not None and activeJob['client'] == client:
+        clientJobs.insert(0, activeJob)
+    clientResults = {t: passes for t, passes in results.items() if passes[0][0]['client'] == client}
+    clientTokens = {j['token'] for j in clientJobs} | set(clientResults)
+    if len(clientTokens) >= MAX_JOBS_PER_CLIENT:
+        # квота освободится, когда завершится ближайшая задача клиента
+        # или истечет срок хранения ее незабранного результата
+        now = time.time()
+        releases = [job_eta(j['token'])[1] - now for j in clientJobs]
+        releases += [passes[-1][2] + RESULT_TTL - now for passes in clientResults.values()]
+        return reject('client_quota', min(releases))
+
+    queued = active_remaining() + sum(j['estimate'] + j['followup'] for j in pendingJobs)
+    # пустую очередь не блокируем, иначе большой запрос не выполнится никогда
+    if queued > 0 and queued + job['estimate'] + job['followup'] > MAX_QUEUED_GPU_SECONDS:
+        return reject('queue_full', queued + job['estimate'] + job['followup'] - MAX_QUEUED_GPU_SECONDS)
+
+    return None
+
 # основной эндпоинт сервера, через него клиент присылает данные для инференса
 @app.route('/inpaint', methods=['POST'])
 def inpainting_handle():
-    global currentToken
-    # проверяем, активна ли сейчас модель
-    if modelIsInferencing.value == 0:
-        queueMIsEmpty = queueM.empty()
-        # проверяем, забран ли результат последнего инференса
-        if queueMIsEmpty:
-            plugin_request = request.json
-            print("[FlaskProcess]: New request: ", plugin_request['prompt'])
-            # обнуляем прогресс модели
-            with modelProgress.get_lock():
-                for i in range(3):
-                    modelProgress[i] = 0
-            queueF.put(('inpaint', plugin_request))
-            with modelIsInferencing.get_lock():
-                modelIsInferencing.value = True
-            # генерируем токен и возращаем его пользователю
-            currentToken = str(uuid.uuid4())
-            return {
-                'status': 'initiated',
-                'token': currentToken
-            }
-        else:
-            return { 'status': 'blocked' }
-    else:
-        return { 'status': 'inferencing' }
+    plugin_request = request.json
+    # квота привязана к адресу клиента, а не к полю запроса, которое можно подделать
+    client = request.remote_addr
+    print("[FlaskProcess]: New request: ", plugin_request['prompt'])
+    # для чернового прохода фиксируем seed, чтобы полный проход его повторил
+    if plugin_request.get('draft', False):
+        if plugin_request.get('seed') is None:
+            plugin_request['seed'] = random.randrange(2 ** 32)
+        plugin_request['draft_decoder_steps'] = max(1, plugin_request['decoder_steps'] // DRAFT_STEPS_DIVIDER)
+        plugin_request['draft_scale'] = DRAFT_SCALE
+        plugin_request.setdefault('refine', 'auto')
+
+    with jobsLock:
+        job = create_job(str(uuid.uuid4()), client, plugin_request)
+        rejection = admit(job)
+        if rejection is not None:
+            return rejection
+
+        pendingJobs.append(job)
+        dispatch()
+        estimated_start, estimated_finish = job_eta(job['token'])
+        # возращаем токен пользователю
+        return {
+            'status': 'initiated',
+            'token': job['token'],
+            'estimated_start': estimated_start,
+            'estimated_finish': estimated_finish
+        }
+
+# эндпоинт для запуска полного прохода после чернового (режим refine == 'manual')
+@app.route('/refine', methods=['POST'])
+def refine_handle():
+    plugin_request = request.json
+    token = plugin_request['token']
+    with jobsLock:
+        # уточнять можно только забранный результат чернового прохода
+        if token not in draftJobs:
+            return { 'status': 'empty' }
+        draftJob, _ = draftJobs[token]
+        job = create_job(
+            token, draftJob['client'], dict(draftJob['request'], draft=False), cached_prior=True)
+        # полный проход по запросу клиента - новая задача, поэтому проходит тот же
+        # контроль допуска и встает в конец очереди; отклоненный запрос можно повторить
+        rejection = admit(job)
+        if rejection is not None:
+            return rejection
+        del draftJobs[token]
+        pendingJobs.append(job)
+        dispatch()
+        estimated_start, estimated_finish = job_eta(token)
+        return {
+            'status': 'initiated',
+            'token': token,
+            'estimated_start': estimated_start,
+            'estimated_finish': estimated_finish
+        }
 
 # эндпоинт, с помощью которого клиент получает прогресс инференса
 @app.route('/progress', methods=['GET'])
 def status_handle():
-    global currentToken
     plugin_request = request.json
-    flatModelProgress = [modelProgress[i] for i in range(3)]
-    return {
-        'status': "inferencing" if modelIsInferencing.value == 1 else "listening",
-        'progress': flatModelProgress if plugin_request['token'] == currentToken else [0,0,0]
-    }
+    token = plugin_request['token']
+    with jobsLock:
+        # незабранный результат (например, черновой при идущем полном проходе)
+        # отдается клиенту раньше, чем прогресс или ошибка следующего прохода
+        if token in results:
+            return {
+                'status': 'listening',
+                'progress': [0, 0, 0],
+                'total': 0
+            }
+        if token in failedJobs:
+            return {
+                'status': 'error',
+                'reason': failedJobs[token][0],
+                'progress': [0, 0, 0],
+                'total': 0
+            }
+        estimated_start, estimated_finish = job_eta(token)
+        if activeJob is not None and activeJob['token'] == token:
+            return {
+                'status': 'inferencing',
+                'progress': [modelProgress[i] for i in range(3)],
+                'total': currentTotalSteps,
+                'estimated_start': estimated_start,
+                'estimated_finish': estimated_finish
+            }
+        for position, job in enumerate(pendingJobs):
+            if job['token'] == token:
+                return {
+                    'status': 'queued',
+                    'position': position,
+                    'progress': [0, 0, 0],
+                    'total': total_steps(job['request']),
+                    'estimated_start': estimated_start,
+                    'estimated_finish': estimated_finish
+                }
+        return {
+            'status': 'listening',
+            'progress': [0, 0, 0],
+            'total': 0
+        }
 
 # эндпоинт для получения результат инференса
 @app.route('/result', methods=['GET'])
 def result_handle():
-    global currentToken
     plugin_request = request.json
-    # токен совпадает с сохраненным на сервере?
-    if plugin_request['token'] == currentToken:
-        # модель неактивна?
-        if modelIsInferencing.value == 0:
-            try:
-                modelResult = queueM.get(block=False)
-                # функция для преобразования PIL Image в плоский массив в кодировке base64 
-                def prepare(img):
-                    pixels = list(img.getdata())
-                    pixels = [y for x in map(lambda x: [*x, 255], pixels) for y in x]
-                    return base64.b64encode(array('B', pixels)).decode('ascii')
-                return {
-                    'status': 'ready',
-                    'images': [prepare(result_image) for result_image in modelResult['images']],
-                    'width': modelResult['width'],
-                    'height': modelResult['height']
-                }
-            except queue.Empty:
-                return { 'status': 'empty' }
-        else:
-            return { 'status': 'inferencing' } 
-    else:
-        if modelIsInferencing.value == 0:
+    token = plugin_request['token']
+    with jobsLock:
+        if token not in results:
+            if token in failedJobs:
+                return { 'status': 'error', 'reason': failedJobs.pop(token)[0] }
+            # задача еще в очереди или в работе?
+            if (activeJob is not None and activeJob['token'] == token) or any(j['token'] == token for j in pendingJobs):
+                return { 'status': 'inferencing' }
             return { 'status': 'listening' }
-        else:
-            return { 'status': 'inferencing' } 
+        job, modelResult, _ = results[token].popleft()
+        if not results[token]:
+            del results[token]
+        response = { 'status': 'ready', 'draft': modelResult['draft'], 'refining': False }
+        # полный проход после чернового уже поставлен в очередь в store_result, если клиент
+        # так просил, иначе запоминаем задачу для эндпоинта /refine
+        if modelResult['draft']:
+            if job['request'].get('refine') == 'auto':
+                response['refining'] = True
+            else:
+                draftJobs[token] = (job, time.time())
+
+    # функция для преобразования PIL Image в плоский массив в кодировке base64
+    def prepare(img):
+        pixels = list(img.getdata())
+        pixels = [y for x in map(lambda x: [*x, 255], pixels) for y in x]
+        return base64.b64encode(array('B', pixels)).decode('ascii')
+    # в разреженном режиме отдаем только ограничивающий прямоугольник маски
+    if plugin_request.get('sparse', False):
+        mask = modelResult['mask'].convert('L')
+        box = mask.getbbox()
+        # при пустом выделении отдаем весь кадр непрозрачным, а не полностью прозрачный слой
+        if box is None:
+            box = (0, 0, modelResult['width'], modelResult['height'])
+            mask = Image.new('L', mask.size, 255)
+        mask = mask.crop(box)
+        # функция для вырезания фрагмента PIL Image с альфа-каналом из маски
+        def prepare_sparse(img):
+            patch = img.convert('RGB').crop(box)
+            patch.putalpha(mask)
+            return base64.b64encode(patch.tobytes()).decode('ascii')
+        response.update({
+            'images': [prepare_sparse(result_image) for result_image in modelResult['images']],
+            'x': box[0],
+            'y': box[1],
+            'width': box[2] - box[0],
+            'height': box[3] - box[1]
+        })
+    else:
+        response.update({
+            'images': [prepare(result_image) for result_image in modelResult['images']],
+            'width': modelResult['width'],
+            'height': modelResult['height']
+        })
+    return response
 
 # функция, вызывающаяся при старте текущего процесса
 def on_app_start():
     global modelProcess
-    global currentToken
+    global latencyModel
+    global pendingJobs
+    global activeJob
+    global results
+    global draftJobs
+    global failedJobs
+    global modelFailure
+    global currentTotalSteps
 
-    currentToken = None
+    # модель длительности итераций, обучается по измерениям вспомогательного процесса
+    latencyModel = LatencyModel()
+    # задачи, ожидающие инференса
+    pendingJobs = collections.deque()
+    # задача, переданная вспомогательному процессу
+    activeJob = None
+    # незабранные результаты: токен -> очередь (задача, результат, время) по проходам
+    results = {}
+    # черновые задачи, ожидающие запроса на полный проход: токен -> (задача, время)
+    draftJobs = {}
+    # задачи, завершившиеся ошибкой: токен -> (причина, время)
+    failedJobs = {}
+    # причина, по которой модель недоступна, или None
+    modelFailure = None
+    currentTotalSteps = 0
 
     modelProcess = ModelProcess(
         queueM, queueF,
-        modelIsInferencing, modelProgress)
+        modelIsInferencing, modelProgress, queueL)
 
     # старт вспомогательного процесса
     modelProcess.start()
 
+    # старт фонового потока, который передает задачи модели
+    threading.Thread(target=dispatch_loop, daemon=True).start()
+
 if __name__ == '__main__':
-    onAppStart()
-    app.run(debug=True, use_reloader=False)
\ No newline at end of file
+    on_app_start()
+    app.run(debug=True, use_reloader=False)